@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# Copyright (C) 2013 Yaacov Zamir <kobi.zamir@gmail.com>
+# Author: Yaacov Zamir (2013)
+
+''' mbs-replay
+
+Replay a modbus repeater traffic capture
+'''
+
+import sys
+import time
+import argparse
+import threading
+
+from struct import pack, unpack
+
+from mbs_server import ModbusRepeater, read_capture
+from mbs_server import CAPTURE_REQUEST, CAPTURE_RESPONSE, CAPTURE_BACKEND
+from mbs_server import CAPTURE_RUN
+
+# Simulated serial backend
+class ReplayBackend:
+    ''' A backend answering with the captured backend answers
+
+        answers are kept in a queue for each request, and are
+        replayed in the captured order, after the captured delay.
+    '''
+    def __init__(self, speed = 1.0):
+        ''' init the simulated backend
+
+        speed -- replay speed, 0 mean do not wait for the bus
+        '''
+        self.speed = speed
+        self.answers = {}
+        self.lock = threading.Lock()
+
+    def add_answer(self, data):
+        ''' add a captured backend answer
+        '''
+        unit, command, addr, count, duration = unpack(">2B2Hd", data[:14])
+        key = (unit, command, addr, count)
+
+        self.answers.setdefault(key, []).append((duration, data[14:]))
+
+    def get_answer(self, unit, command, addr, count):
+        ''' get the next answer for a request, and wait like the bus did
+        '''
+        self.lock.acquire()
+        try:
+            duration, answer = self.answers[(unit, command, addr, count)].pop(0)
+        except (KeyError, IndexError):
+            raise Exception('No captured answer')
+        finally:
+            self.lock.release()
+
+        if self.speed:
+            time.sleep(duration / self.speed)
+
+        return answer
+
+    def get_holding_registers(self, unit, addr, count):
+        ''' get captured holding registers
+        '''
+        return self.get_answer(unit, 0x03, addr, count) or None
+
+    def get_input_registers(self, unit, addr, count):
+        ''' get captured input registers
+        '''
+        return self.get_answer(unit, 0x04, addr, count) or None
+
+    def set_input_registers(self, unit, addr, count, registers):
+        ''' get captured write answer (addr and number of registers writen)
+
+        like SerialModbus, answer [0, 0] when there is no captured answer
+        '''
+        try:
+            return unpack(">2H", self.get_answer(unit, 0x10, addr, count))
+        except Exception, e:
+            return [0, 0]
+
+# Simulated tcp connection
+class ReplayConnection:
+    ''' A tcp connection sending the captured requests of one channel
+        at the captured times, and collecting the repeater responses
+    '''
+    def __init__(self, requests, start_time, speed = 1.0):
+        ''' init the simulated connection
+
+        requests -- list of (timestamp, data) captured requests
+        start_time -- capture time to count the requests time from
+        speed -- replay speed, 0 mean send requests without waiting
+        '''
+        self.requests = requests
+        self.start_time = start_time
+        self.speed = speed
+
+        self.responses = []
+        self.latencies = []
+        self.request_time = None
+        self.replay_start = None
+
+    def recv(self, size):
+        ''' return the next request, when it's time come
+        '''
+        if not self.requests:
+            return ''
+
+        timestamp, data = self.requests.pop(0)
+
+        # wait until the request time (relative to replay start)
+        if self.speed:
+            delay = (timestamp - self.start_time) / self.speed
+            delay -= time.time() - self.replay_start
+            if delay > 0:
+                time.sleep(delay)
+
+        self.request_time = time.time()
+        return data
+
+    def send(self, data):
+        ''' collect a response, and measure the request latency
+        '''
+        self.latencies.append(time.time() - self.request_time)
+        self.responses.append(data)
+
+        return len(data)
+
+    def close(self):
+        pass
+
+def load_capture(filename, speed = 1.0):
+    ''' load a capture file
+
+    each connection is keyed by (run, channel), and gets its own
+    simulated backend, so answers are not shared between connections.
+
+    return the simulated backends, the simulated connections
+    and the captured responses, for each connection
+    '''
+    backends = {}
+    requests = {}
+    responses = {}
+    start_times = {}
+    run = 0
+
+    for timestamp, kind, channel, data in read_capture(filename):
+        # a new repeater run, channels numbering restart
+        if kind == CAPTURE_RUN:
+            run += 1
+            start_times[run] = timestamp
+            continue
+
+        start_times.setdefault(run, timestamp)
+        key = (run, channel)
+
+        if kind == CAPTURE_REQUEST:
+            requests.setdefault(key, []).append((timestamp, data))
+        elif kind == CAPTURE_RESPONSE:
+            responses.setdefault(key, []).append(data)
+        elif kind == CAPTURE_BACKEND:
+            if key not in backends:
+                backends[key] = ReplayBackend(speed)
+            backends[key].add_answer(data)
+
+    connections = {}
+    for key in requests:
+        connections[key] = ReplayConnection(requests[key],
+            start_times[key[0]], speed)
+        backends.setdefault(key, ReplayBackend(speed))
+
+    return backends, connections, responses
+
+def replay(filename, speed = 1.0, debug = False):
+    ''' replay a capture file through modbus repeaters
+
+    runs are replayed one after the other, the connections of a run
+    are replayed together, each with its own repeater and backend.
+
+    return the replay connections and the captured responses
+    '''
+    backends, connections, responses = load_capture(filename, speed)
+
+    for run in sorted(set([key[0] for key in connections])):
+        # replay each channel in it's own thread, like the repeater does
+        threads = []
+        replay_start = time.time()
+        for key, conn in sorted(connections.items()):
+            if key[0] != run:
+                continue
+
+            repeater = ModbusRepeater(None, backends[key])
+            conn.replay_start = replay_start
+            thread = threading.Thread(target = repeater.handle,
+                args = (conn, 'replay:%d:%d' % key, debug, key[1]))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+    return connections, responses
+
+def main():
+    ''' get user arguments and replay a capture file
+    '''
+    parser = argparse.ArgumentParser(description='Modbus capture replay.')
+
+    parser.add_argument('capture',
+                       help='traffic capture file')
+    parser.add_argument('-s', dest='speed',
+                       type=float, default=1.0,
+                       help='replay speed, 0 for no delays (default: 1)')
+    parser.add_argument('-d', dest='debug', action='store_const',
+                       const=True, default=False,
+                       help='print debug information')
+    args = parser.parse_args()
+
+    # print message
+    print
+    print "Modbus capture replay"
+    print "---------------------"
+    print "capture file:      ", args.capture
+    print "replay speed:      ", args.speed
+    print
+
+    try:
+        start_time = time.time()
+        connections, responses = replay(args.capture, args.speed, args.debug)
+        run_time = time.time() - start_time
+    except Exception, e:
+        print "Err: can't replay capture,", e
+        sys.exit(1)
+
+    # compare each response with the captured one,
+    # missing or extra responses are mismatches too
+    latencies = []
+    mismatches = 0
+    for key, conn in sorted(connections.items()):
+        latencies += conn.latencies
+        captured = responses.get(key, [])
+
+        for i in range(max(len(conn.responses), len(captured))):
+            if conn.responses[i:i + 1] != captured[i:i + 1]:
+                mismatches += 1
+                if args.debug:
+                    print "Run %d channel %d response %d mismatch" % (key + (i,))
+
+    print "connections:       ", len(connections)
+    print "responses:         ", len(latencies)
+    print "mismatched resp:   ", mismatches
+    print "replay time:        %.3f sec" % run_time
+
+    if latencies:
+        latencies.sort()
+        print "latency avg:        %.6f sec" % (sum(latencies) / len(latencies))
+        print "latency median:     %.6f sec" % latencies[len(latencies) / 2]
+        print "latency max:        %.6f sec" % latencies[-1]
+    print
+
+    if mismatches:
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
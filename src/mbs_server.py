@@ -27,11 +27,17 @@ import sys
 import time
 import datetime
 import argparse
+import json
+from math import isnan, isinf
 
 from socket import socket, AF_INET, SOCK_STREAM
+from socket import error as SocketError
 from serial import Serial
 from struct import pack, unpack
-from thread import start_new_thread
+from struct import error as StructError
+from thread import start_new_thread, allocate_lock
+from Queue import Queue, Full, Empty
+from select import select
 
 try:
     # try to import python tal serial module
@@ -40,6 +46,148 @@ try:
 except:
     pass
 
+# Traffic capture record kinds
+CAPTURE_REQUEST = 1    # tcp request received by the repeater
+CAPTURE_RESPONSE = 2   # tcp response sent by the repeater
+CAPTURE_BACKEND = 3    # backend answer, with the time it took
+CAPTURE_SERIAL_TX = 4  # frame written to the serial line
+CAPTURE_SERIAL_RX = 5  # frame read from the serial line
+CAPTURE_RUN = 6        # repeater started, channels numbering restart
+
+CAPTURE_MAGIC = 'MBSCAP1\n'
+CAPTURE_HEADER = ">dBIH"
+CAPTURE_HEADER_SIZE = 15
+
+# Traffic capture
+class TrafficCapture:
+    ''' An append only binary log of the repeater traffic
+        
+        The log starts with CAPTURE_MAGIC, followed by records:
+            pack(">dBIH", time, kind, channel, length) + data
+        
+        channel is the tcp connection number (0 for serial frames).
+        Each run of the repeater starts with a CAPTURE_RUN record.
+        CAPTURE_BACKEND data is:
+            pack(">2B2Hd", unit, command, addr, count, duration) + answer
+    '''
+    
+    def __init__(self, filename, buffer_size = 65536):
+        ''' open the capture file for buffered appending
+        '''
+        self.lock = allocate_lock()
+        self.capture_file = open(filename, 'ab', buffer_size)
+        
+        # in append mode, position is not at the end until the first write
+        self.capture_file.seek(0, 2)
+        
+        if self.capture_file.tell() == 0:
+            # new file, write the header
+            self.capture_file.write(CAPTURE_MAGIC)
+        else:
+            # existing file, make sure it's a capture file, and drop
+            # the last record if it was cut, e.g. the server was killed
+            self.capture_file.close()
+            
+            check_file = open(filename, 'r+b')
+            try:
+                capture_end = find_capture_end(check_file)
+                check_file.truncate(capture_end)
+            finally:
+                check_file.close()
+            
+            self.capture_file = open(filename, 'ab', buffer_size)
+            self.capture_file.seek(0, 2)
+        
+        # mark a new run, channels of different runs are not mixed
+        self.record(CAPTURE_RUN, 0, '')
+    
+    def record(self, kind, channel, data):
+        ''' append one record to the capture file
+        
+        capture errors are ignored, they must not stop the repeater
+        '''
+        try:
+            header = pack(CAPTURE_HEADER, time.time(), kind, channel, len(data))
+        except StructError:
+            return
+        
+        self.lock.acquire()
+        try:
+            self.capture_file.write(header + data)
+        except (IOError, ValueError):
+            pass
+        finally:
+            self.lock.release()
+    
+    def record_backend(self, channel, unit, command, addr, count, 
+            duration, answer):
+        ''' append one backend answer to the capture file
+        '''
+        self.record(CAPTURE_BACKEND, channel, pack(">2B2Hd", 
+            unit, command, addr, count, duration) + answer)
+    
+    def close(self):
+        ''' flush and close the capture file
+        '''
+        self.lock.acquire()
+        try:
+            self.capture_file.close()
+        finally:
+            self.lock.release()
+
+def find_capture_end(capture_file):
+    ''' find the end of the last complete record of a capture file
+    
+    capture_file -- a capture file open for reading
+    '''
+    capture_file.seek(0)
+    if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise Exception('Not a capture file')
+    
+    capture_file.seek(0, 2)
+    file_size = capture_file.tell()
+    capture_end = len(CAPTURE_MAGIC)
+    
+    while capture_end + CAPTURE_HEADER_SIZE <= file_size:
+        capture_file.seek(capture_end)
+        header = capture_file.read(CAPTURE_HEADER_SIZE)
+        length = unpack(CAPTURE_HEADER, header)[3]
+        
+        if capture_end + CAPTURE_HEADER_SIZE + length > file_size:
+            break
+        
+        capture_end += CAPTURE_HEADER_SIZE + length
+    
+    return capture_end
+
+def read_capture(filename):
+    ''' iterate over the records of a capture file
+    
+    yield (timestamp, kind, channel, data) tuples
+    '''
+    capture_file = open(filename, 'rb')
+    
+    if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        capture_file.close()
+        raise Exception('Not a capture file')
+    
+    try:
+        while True:
+            header = capture_file.read(CAPTURE_HEADER_SIZE)
+            if len(header) < CAPTURE_HEADER_SIZE:
+                break
+            
+            timestamp, kind, channel, length = unpack(CAPTURE_HEADER, header)
+            data = capture_file.read(length)
+            
+            # last record was cut, e.g. the server was killed
+            if len(data) < length:
+                break
+            
+            yield timestamp, kind, channel, data
+    finally:
+        capture_file.close()
+
 # Serial port communication
 class SerialTal():
     ''' Serial port with partial tal functionality
@@ -56,6 +204,8 @@ class SerialTal():
         self.cache = {}
         self.com = create_com('tal://%s/' % tal_addr)
         self.cache_validity_time = 1 # cache is valid for 1 sec
+        self.stream = None # change stream, updated on cache refresh
+        self.lock = allocate_lock() # one tal transaction at a time
     
     def check_cache(self, key):
         ''' check cached value for a key'''
@@ -116,10 +266,13 @@ class SerialTal():
         
         # get items from unit
         items = range(int(addr / 2) + 1, int((addr + count) / 2) + 1)
+        self.lock.acquire()
         try:
             response = self.com.get_par(0, unit, items)
         except:
             responce = None
+        finally:
+            self.lock.release()
         
         # tal use parameters and not registers. command 3 in tal mean
         # answer is in unsigned ints, command 4 in tal mean answer is float
@@ -134,6 +287,11 @@ class SerialTal():
             
             # update the cache
             self.update_cache(key, ans)
+            
+            # push changed values to subscribers
+            if self.stream:
+                self.stream.update(unit, addr, count, command, ans,
+                    float_values = (command == 0x04))
         
         return ans
     
@@ -150,6 +308,7 @@ class SerialTal():
         reg_count = 0
         byte_index = 0
         
+        self.lock.acquire()
         try:
             # tal can only write one float at a time 
             while reg_count < count:
@@ -162,9 +321,26 @@ class SerialTal():
                 byte_index += 4
         except:
             pass
+        finally:
+            self.lock.release()
         
         # return addr and number of registers writen
         return [addr, reg_count]
+    
+    def refresh_registers(self, ranges, interval):
+        ''' refresh registers forever, feeding the change stream
+        
+        ranges -- list of (unit, command, addr, count) to read
+        interval -- seconds between refreshes
+        '''
+        while True:
+            for unit, command, addr, count in ranges:
+                try:
+                    self.get_registers(unit, addr, count, command = command)
+                except:
+                    pass
+            
+            time.sleep(interval)
 
 # Serial port communication
 class SerialModbus(Serial):
@@ -180,6 +356,9 @@ class SerialModbus(Serial):
     '''
     cache = {}
     cache_validity_time = 1 # cache is valid for 1 sec
+    stream = None # change stream, updated on cache refresh
+    capture = None # traffic capture, records serial frames
+    lock = allocate_lock() # one serial transaction at a time
     
     def check_cache(self, key):
         ''' check cached value for a key'''
@@ -258,24 +437,38 @@ class SerialModbus(Serial):
             # blank response, and continue
             ans = None
         
-        # make sure no leftovers in buffers
-        self.flushInput()
-        self.flushOutput()
-        
-        # build modbus request
-        msg = pack('>2B2H', unit, command, addr, count)
-        msg = msg + self.calc_crc16(msg)
-        self.write(msg)
-        
-        # wait for answer (do not check CRC)
-        answer_length = 3 + count * 2
-        replay = self.read(answer_length)
+        self.lock.acquire()
+        try:
+            # make sure no leftovers in buffers
+            self.flushInput()
+            self.flushOutput()
+            
+            # build modbus request
+            msg = pack('>2B2H', unit, command, addr, count)
+            msg = msg + self.calc_crc16(msg)
+            self.write(msg)
+            
+            if self.capture:
+                self.capture.record(CAPTURE_SERIAL_TX, 0, msg)
+            
+            # wait for answer (do not check CRC)
+            answer_length = 3 + count * 2
+            replay = self.read(answer_length)
+            
+            if self.capture:
+                self.capture.record(CAPTURE_SERIAL_RX, 0, replay)
+        finally:
+            self.lock.release()
         
         # if we have and answer, update the cache
         if len(replay) == answer_length:
             ans = replay[3:]
             self.update_cache(key, ans)
             
+            # push changed values to subscribers
+            if self.stream:
+                self.stream.update(unit, addr, count, command, ans)
+            
         return ans
     
     def set_input_registers(self, unit, addr, count, registers):
@@ -291,23 +484,273 @@ class SerialModbus(Serial):
         command = 0x10
         answer_length = 8
         
-        # make sure no leftovers in buffers
-        self.flushInput()
-        self.flushOutput()
-        
-        # build modbus request
-        msg = pack('>2B2HB', unit, command, addr, count, count * 2) + registers
-        msg = msg + self.calc_crc16(msg)
-        self.write(msg)
-        
-        # wait for answer (do not check CRC)
-        replay = self.read(answer_length)
+        self.lock.acquire()
+        try:
+            # make sure no leftovers in buffers
+            self.flushInput()
+            self.flushOutput()
+            
+            # build modbus request
+            msg = pack('>2B2HB', unit, command, addr, count, count * 2) + registers
+            msg = msg + self.calc_crc16(msg)
+            self.write(msg)
+            
+            if self.capture:
+                self.capture.record(CAPTURE_SERIAL_TX, 0, msg)
+            
+            # wait for answer (do not check CRC)
+            replay = self.read(answer_length)
+            
+            if self.capture:
+                self.capture.record(CAPTURE_SERIAL_RX, 0, replay)
+        finally:
+            self.lock.release()
         
         # if we have and answer, get the addr and number of registers
         if len(replay) == answer_length:
             ans = unpack(">2H", replay[4:])
             
         return ans
+    
+    def refresh_registers(self, ranges, interval):
+        ''' refresh registers forever, feeding the change stream
+        
+        ranges -- list of (unit, command, addr, count) to read
+        interval -- seconds between refreshes
+        '''
+        while True:
+            for unit, command, addr, count in ranges:
+                try:
+                    self.get_registers(unit, addr, count, command = command)
+                except:
+                    pass
+            
+            time.sleep(interval)
+
+# Register change stream subscriber
+class StreamSubscriber:
+    ''' One change stream subscriber, with a bounded queue of messages
+        
+        Messages are sent by the subscriber own thread, so a subscriber
+        that stops reading can't block the serial read path, it is
+        disconnected when its queue is full.
+        
+        While there are no messages, the subscriber is checked every
+        check_interval seconds, and closed if it disconnected.
+    '''
+    
+    def __init__(self, conn, queue_size = 256, send_timeout = 5,
+            check_interval = 1):
+        ''' init the subscriber
+
+        conn -- the subscriber tcp/ip connection
+        queue_size -- max number of messages waiting to be sent
+        send_timeout -- seconds to wait for a blocked send
+        check_interval -- seconds between disconnection checks
+        '''
+        self.conn = conn
+        self.conn.settimeout(send_timeout)
+        self.queue = Queue(queue_size)
+        self.check_interval = check_interval
+        self.closed = False
+    
+    def push(self, message):
+        ''' queue a message, return False if the subscriber fell behind
+        '''
+        if self.closed:
+            return False
+        
+        try:
+            self.queue.put_nowait(message)
+        except Full:
+            self.closed = True
+            return False
+        
+        return True
+    
+    def run(self):
+        ''' send queued messages until the subscriber is closed
+        '''
+        while not self.closed:
+            try:
+                message = self.queue.get(timeout = self.check_interval)
+            except Empty:
+                # no changes, check that the subscriber is still here
+                if self.disconnected():
+                    self.closed = True
+                continue
+            
+            try:
+                self.conn.sendall(message)
+            except SocketError:
+                self.closed = True
+        
+        self.conn.close()
+    
+    def disconnected(self):
+        ''' check if the subscriber closed its connection
+        
+        subscribers do not send data, a readable connection that
+        returns no data (or fails) is closed, other data is ignored
+        '''
+        try:
+            readable = select([self.conn], [], [], 0)[0]
+            return bool(readable) and not self.conn.recv(1024)
+        except SocketError:
+            return True
+
+# Register change stream
+class ChangeStream:
+    ''' A local streaming socket, pushing register changes to subscribers
+        
+        Each time the backend refresh its cache, the new registers are
+        compared with the previous image, and only registers that moved
+        more then their deadband are sent to the subscribers.
+        
+        Tal input registers (command 0x04) are floats, one value for each
+        two registers, other registers are unsigned 16 bit values.
+        
+        Available stream formats:
+            json: one json object per line
+                {"time": t, "unit": u, "command": c, "addr": a, "value": v}
+            binary: one 20 bytes record per change
+                pack(">d2BHd", time, unit, command, addr, value)
+    '''
+    
+    def __init__(self, soc, deadband = 0, deadbands = None, 
+            stream_format = 'json'):
+        ''' init the change stream
+        
+        soc -- a listening tcp/ip socket for subscribers
+        deadband -- default deadband for all registers
+        deadbands -- per tag deadbands, {(unit, command, addr): deadband}
+        stream_format -- 'json' or 'binary'
+        '''
+        self.soc = soc
+        self.deadband = deadband
+        self.deadbands = deadbands or {}
+        self.stream_format = stream_format
+        
+        # last reported value of each tag, {(unit, command, addr): value}
+        self.image = {}
+        self.subscribers = []
+        self.lock = allocate_lock()
+    
+    def pack_change(self, timestamp, unit, command, addr, value):
+        ''' pack one register change as a stream record
+        
+        in json, nan and inf values are sent as null
+        '''
+        if self.stream_format == 'binary':
+            return pack(">d2BHd", timestamp, unit, command, addr, value)
+        
+        # json has no nan or inf, send them as null
+        if isnan(value) or isinf(value):
+            value = None
+        
+        return json.dumps({'time': timestamp, 'unit': unit,
+            'command': command, 'addr': addr, 'value': value}) + '\n'
+    
+    def is_change(self, value, last, deadband):
+        ''' check if a value moved more then the deadband from the last one
+        
+        nan and inf can't be compared, they are a change when they
+        come or go (e.g. a tal float that is nan until the unit is ready)
+        '''
+        if isnan(value) or isinf(value) or isnan(last) or isinf(last):
+            return repr(value) != repr(last)
+        
+        return abs(value - last) > deadband
+    
+    def update(self, unit, addr, count, command, registers, 
+            float_values = False):
+        ''' compare new registers with the image and queue the deltas
+
+        unit -- modbus unit number
+        addr -- start addres
+        count -- number of registers read
+        command -- the modbus command used
+        registers -- the packed registers data
+        float_values -- registers are packed floats (two registers each)
+        '''
+        try:
+            if float_values:
+                values = unpack(">%df" % (count / 2), registers)
+                step = 2
+            else:
+                values = unpack(">%dH" % count, registers)
+                step = 1
+        except Exception, e:
+            return
+        
+        timestamp = time.time()
+        records = []
+        
+        self.lock.acquire()
+        try:
+            for i, value in enumerate(values):
+                tag = (unit, command, addr + i * step)
+                deadband = self.deadbands.get(tag, self.deadband)
+                last = self.image.get(tag)
+                
+                # report only values that moved more then the deadband
+                if last is None or self.is_change(value, last, deadband):
+                    self.image[tag] = value
+                    records.append(self.pack_change(timestamp, 
+                        unit, command, addr + i * step, value))
+            
+            if records:
+                self.push(''.join(records))
+        finally:
+            self.lock.release()
+    
+    def push(self, message):
+        ''' queue a message to all subscribers, drop the ones that fell behind
+        
+        do not block, subscribers send the messages in their own thread
+        '''
+        for subscriber in self.subscribers[:]:
+            if not subscriber.push(message):
+                self.subscribers.remove(subscriber)
+    
+    def subscribe(self, conn):
+        ''' add a new subscriber, and queue it the current image
+        '''
+        subscriber = StreamSubscriber(conn)
+        timestamp = time.time()
+        
+        self.lock.acquire()
+        try:
+            records = [self.pack_change(timestamp, unit, command, addr, value)
+                for (unit, command, addr), value in sorted(self.image.items())]
+            
+            if records:
+                subscriber.push(''.join(records))
+            self.subscribers.append(subscriber)
+        finally:
+            self.lock.release()
+        
+        start_new_thread(self.serve, (subscriber,))
+    
+    def serve(self, subscriber):
+        ''' run a subscriber, and remove it when it is closed
+        '''
+        try:
+            subscriber.run()
+        finally:
+            self.lock.acquire()
+            try:
+                if subscriber in self.subscribers:
+                    self.subscribers.remove(subscriber)
+            finally:
+                self.lock.release()
+    
+    def run(self):
+        ''' accept subscribers forever function
+        '''
+        while True:
+            conn, addr = self.soc.accept()
+            self.subscribe(conn)
 
 # Modbus tcp->serial repeater
 class ModbusRepeater:
@@ -333,6 +776,9 @@ class ModbusRepeater:
         #    get_holding_registers
         #    set_input_registers
         self.backend = backend
+        
+        # traffic capture, records requests, responses and backend answers
+        self.capture = None
     
     def dump_registers(self, registers):
         ''' dump registers to console
@@ -342,8 +788,10 @@ class ModbusRepeater:
             print hex(ord(c)),
         print
         
-    def handle(self, conn, addr, debug = False):
+    def handle(self, conn, addr, debug = False, channel = 0):
         ''' handle one modbus connection
+        
+        channel -- connection number, used by the traffic capture
         '''
         if debug: print 'Connected by', addr
         
@@ -354,6 +802,9 @@ class ModbusRepeater:
             if not data:
                 break
             
+            if self.capture:
+                self.capture.record(CAPTURE_REQUEST, channel, data)
+            
             # parse the new request
             try:
                 packat_id, protocol, length, unit, command = unpack(">3H2B", data[:8])
@@ -371,11 +822,21 @@ class ModbusRepeater:
                 registers = data[13:]
                 if debug: self.dump_registers(registers)
                 
+                start_time = time.time()
                 ans_addr, ans_count = self.backend.set_input_registers(unit, addr, count, registers)
                 
+                if self.capture:
+                    self.capture.record_backend(channel, unit, command, 
+                        addr, count, time.time() - start_time, 
+                        pack(">2H", ans_addr, ans_count))
+                
                 # return the addres and number of registers writen
-                conn.send(pack(">3H2B2H", packat_id, protocol, 
-                    count * 2 + 3, unit, command, ans_addr, ans_count))
+                response = pack(">3H2B2H", packat_id, protocol, 
+                    count * 2 + 3, unit, command, ans_addr, ans_count)
+                conn.send(response)
+                
+                if self.capture:
+                    self.capture.record(CAPTURE_RESPONSE, channel, response)
                 
             # if command is read input/holding registers, try to read serial/tal port
             if command in [0x03, 0x04]:
@@ -385,6 +846,7 @@ class ModbusRepeater:
                 
                 # try to read registers using the serial backend
                 registers = None
+                start_time = time.time()
                 try:
                     if command == 0x03:
                         registers = self.backend.get_holding_registers(unit, addr, count)
@@ -393,12 +855,20 @@ class ModbusRepeater:
                 except Exception, e:
                     if debug: print "Bad backend response"
                     break
+                
+                if self.capture:
+                    self.capture.record_backend(channel, unit, command, 
+                        addr, count, time.time() - start_time, registers or '')
                     
                 if registers:
                     if debug: self.dump_registers(registers)
                     
-                    conn.send(pack(">3H3B", packat_id, protocol, 
-                        count * 2 + 3, unit, command, count * 2) + registers)
+                    response = pack(">3H3B", packat_id, protocol, 
+                        count * 2 + 3, unit, command, count * 2) + registers
+                    conn.send(response)
+                    
+                    if self.capture:
+                        self.capture.record(CAPTURE_RESPONSE, channel, response)
         
         conn.close()
         if debug: print "Connection closed"
@@ -406,13 +876,18 @@ class ModbusRepeater:
     def run(self, debug=False):
         ''' serve forever function
         '''
+        channel = 0
+        
         # serve forever
         while True:
             # wait for a new request
             conn, addr = self.soc.accept()
             
+            # channel numbers are 1 .. 0xffffffff (0 is the serial line)
+            channel = channel % 0xffffffff + 1
+            
             # respond in a new thread
-            start_new_thread(self.handle, (conn, addr, debug))
+            start_new_thread(self.handle, (conn, addr, debug, channel))
 
 def main():
     ''' get user arguments and run the modbus repeater
@@ -437,8 +912,70 @@ def main():
     parser.add_argument('-d', dest='debug', action='store_const',
                        const=True, default=False,
                        help='print debug information')
+    parser.add_argument('-s', dest='stream_port',
+                       type=int, default=False,
+                       help='local port to stream register changes')
+    parser.add_argument('-f', dest='stream_format',
+                       choices=['json', 'binary'], default='json',
+                       help='register changes stream format (default: json)')
+    parser.add_argument('-e', dest='deadband',
+                       type=float, default=0,
+                       help='register changes deadband (default: 0)')
+    parser.add_argument('-E', dest='deadbands',
+                       action='append', default=[],
+                       help='tag deadband as UNIT:COMMAND:ADDR:DEADBAND')
+    parser.add_argument('-R', dest='refresh_ranges',
+                       action='append', default=[],
+                       help='registers to refresh as UNIT:COMMAND:ADDR:COUNT')
+    parser.add_argument('-i', dest='refresh_interval',
+                       type=float, default=None,
+                       help='registers refresh interval in sec (default: 1)')
+    parser.add_argument('-w', dest='capture',
+                       default=False,
+                       help='write a traffic capture to file')
     args = parser.parse_args()
     
+    # register changes stream options
+    if not args.stream_port and (args.deadbands or args.refresh_ranges or
+            args.refresh_interval is not None):
+        parser.error('-E, -R and -i need a stream port (-s)')
+    
+    if args.refresh_interval is None:
+        args.refresh_interval = 1
+    elif args.refresh_interval <= 0:
+        parser.error('refresh interval must be positive: %s' % 
+            args.refresh_interval)
+    
+    deadbands = {}
+    for tag in args.deadbands:
+        try:
+            unit, command, addr, deadband = tag.split(':')
+            unit, command, addr = int(unit), int(command), int(addr)
+            deadband = float(deadband)
+        except ValueError:
+            parser.error('bad deadband, use UNIT:COMMAND:ADDR:DEADBAND: %s' % tag)
+        
+        if command not in (0x03, 0x04):
+            parser.error('deadband command must be 3 or 4: %s' % tag)
+        
+        deadbands[(unit, command, addr)] = deadband
+    
+    ranges = []
+    for refresh_range in args.refresh_ranges:
+        try:
+            unit, command, addr, count = [int(el) 
+                for el in refresh_range.split(':')]
+        except ValueError:
+            parser.error('bad range, use UNIT:COMMAND:ADDR:COUNT: %s' % 
+                refresh_range)
+        
+        if command not in (0x03, 0x04):
+            parser.error('range command must be 3 or 4: %s' % refresh_range)
+        if count < 1:
+            parser.error('range count must be positive: %s' % refresh_range)
+        
+        ranges.append((unit, command, addr, count))
+    
     # serial port
     if args.tal:
         ser = SerialTal(args.tal)
@@ -467,6 +1004,39 @@ def main():
         print "serial baudrate:   ", args.baudrate
         print "serial parity:     ", args.parity
         
+    # register changes stream
+    if args.stream_port:
+        stream_soc = socket(AF_INET, SOCK_STREAM)
+        stream_soc.bind(("127.0.0.1", args.stream_port))
+        stream_soc.listen(5)
+        
+        ser.stream = ChangeStream(stream_soc, args.deadband, deadbands,
+            args.stream_format)
+        start_new_thread(ser.stream.run, ())
+        
+        # refresh registers, so subscribers get changes without pollers
+        if ranges:
+            start_new_thread(ser.refresh_registers, 
+                (ranges, args.refresh_interval))
+        
+        print "stream on port:    ", args.stream_port
+        print "stream format:     ", args.stream_format
+        print "stream deadband:   ", args.deadband
+        
+        if ranges:
+            print "refresh interval:  ", args.refresh_interval
+        
+    # traffic capture
+    capture = None
+    if args.capture:
+        capture = TrafficCapture(args.capture)
+        
+        # tal backend has no raw serial frames to capture
+        if not args.tal:
+            ser.capture = capture
+        
+        print "capture to file:   ", args.capture
+        
     print "start time is:     ", datetime.datetime.now()
     print
     print "press Ctrl+C to exit"
@@ -474,7 +1044,14 @@ def main():
     
     # run the repeater
     m = ModbusRepeater(soc, ser)
-    m.run(debug=args.debug)
+    m.capture = capture
+    
+    try:
+        m.run(debug=args.debug)
+    finally:
+        # flush the capture buffer
+        if capture:
+            capture.close()
 
 if __name__ == '__main__':
     main()
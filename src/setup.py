@@ -11,6 +11,7 @@ setup(
             'dll_excludes': ['w9xpopen.exe']
         }
     },
-    console = [{'script': "mbs_server.py"}, {'script': "mbs_client.py"}],
+    console = [{'script': "mbs_server.py"}, {'script': "mbs_client.py"},
+        {'script': "mbs_replay.py"}],
     zipfile = None,
 )